@@ -1,11 +1,23 @@
 from twitchio.ext import commands
 # from twitchio.errors import AuthenticationError
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import requests
+from google.oauth2 import service_account
+import httpx
+import orjson
 import os
+import random
+import re
+import stat
 import asyncio
+import contextlib
 import logging
+import time
+import tempfile
+from pathlib import Path
+from datetime import datetime, timezone
+from itertools import zip_longest
+from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import Request
 from dotenv import load_dotenv
 
 # Configure logging to console and file
@@ -28,39 +40,45 @@ TWITCH_ACCESS_TOKEN = os.getenv("TWITCH_ACCESS_TOKEN")
 TWITCH_REFRESH_TOKEN = os.getenv("TWITCH_REFRESH_TOKEN")
 TWITCH_BROADCASTER_ID = os.getenv("TWITCH_BROADCASTER_ID")
 
-# Initialize Google Sheets
+# Lines in .env holding the Twitch tokens rewritten after a refresh
+ENV_TOKEN_PATTERN = re.compile(rb"^(TWITCH_(?:ACCESS|REFRESH)_TOKEN)=[^\r\n]*", re.M)
+
+# Google Sheets
 GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
-try:
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name("sheet_credentials.json", scope)
-    client = gspread.authorize(creds)
-    sheet = client.open_by_key(GOOGLE_SHEET_ID).sheet1
-except Exception as e:  # which exception
-    logging.error(f"Failed to initialize Google Sheets: {e}")
-    sheet = None
 
 
-def validate_token(token):
+def init_sheet():
+    """Authorize with Google and open the points worksheet. Return None on failure."""
+    try:
+        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+        creds = service_account.Credentials.from_service_account_file("sheet_credentials.json", scopes=scope)
+        client = gspread.authorize(creds)
+        return client.open_by_key(GOOGLE_SHEET_ID).sheet1
+    except Exception as e:  # which exception
+        logging.error(f"Failed to initialize Google Sheets: {e}")
+        return None
+
+
+async def validate_token(http, token):
     """Check if the Access Token is valid and return seconds until expiration."""
-    url = "https://id.twitch.tv/oauth2/validate"
     headers = {"Authorization": f"OAuth {token}"}
     try:
-        response = requests.get(url, headers=headers)
+        response = await http.get("/oauth2/validate", headers=headers)
         logging.info(f"Token validation response: {response.status_code}")
         if response.status_code == 200:
-            expires_in = response.json().get("expires_in", 0)
-            scopes = response.json().get("scopes", [])
+            data = orjson.loads(response.content)
+            expires_in = data.get("expires_in", 0)
+            scopes = data.get("scopes", [])
             logging.info(f"Token expires in {expires_in} seconds. Scopes: {scopes}")
             return expires_in, scopes
         return 0, []
-    except requests.RequestException as e:
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         logging.error(f"Token validation failed: {e}")
-        return 0
+        return 0, []
 
 
-def refresh_access_token(refresh_token_value):
+async def refresh_access_token(http, refresh_token_value):
     """Refresh access token and return new tokens."""
-    url = "https://id.twitch.tv/oauth2/token"
     data = {
         "client_id": TWITCH_CLIENT_ID,
         "client_secret": TWITCH_CLIENT_SECRET,
@@ -68,49 +86,61 @@ def refresh_access_token(refresh_token_value):
         "refresh_token": refresh_token_value
     }
     try:
-        response = requests.post(url, data=data)
+        response = await http.post("/oauth2/token", data=data)
         logging.info(f"Token refresh response: {response.status_code}")
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             logging.info("Token refreshed successfully")
             return data["access_token"], data["refresh_token"]
         else:
             logging.error(f"Error refreshing token: {response.status_code} - {response.text}")
             logging.error("Regenerate tokens using: twitch token -u -s 'chat:read chat:edit channel:manage:redemptions channel:read:redemptions user:read:chat user:write:chat'")
             return None, None
-    except requests.RequestException as e:
+    except (httpx.HTTPError, orjson.JSONDecodeError, KeyError) as e:
         logging.error(f"Token refresh failed: {e}")
         return None, None
 
 
 def update_env_file(access_token, refresh_token_value):
-    """Manually update .env file with new tokens."""
+    """Manually update .env file with new tokens, replacing it atomically."""
+    updates = {
+        b"TWITCH_ACCESS_TOKEN": access_token.encode(),
+        b"TWITCH_REFRESH_TOKEN": refresh_token_value.encode()
+    }
+    replaced = set()
+
+    def substitute(match):
+        key = match.group(1)
+        replaced.add(key)
+        return key + b"=" + updates[key]
+
+    tmp_path = None
     try:
-        env_path = os.path.abspath(".env")
+        env_path = Path(".env").resolve()
         logging.info(f"Updating .env at: {env_path}")
-        with open(env_path, "r") as f:
-            lines = f.readlines()
-        new_lines = []
-        access_updated = False
-        refresh_updated = False
-        for line in lines:
-            if line.startswith("TWITCH_ACCESS_TOKEN="):
-                new_lines.append(f"TWITCH_ACCESS_TOKEN={access_token}\n")
-                access_updated = True
-            elif line.startswith("TWITCH_REFRESH_TOKEN="):
-                new_lines.append(f"TWITCH_REFRESH_TOKEN={refresh_token_value}\n")
-                refresh_updated = True
-            else:
-                new_lines.append(line)
-        if not access_updated:
-            new_lines.append(f"TWITCH_ACCESS_TOKEN={access_token}\n")
-        if not refresh_updated:
-            new_lines.append(f"TWITCH_REFRESH_TOKEN={refresh_token_value}\n")
-        with open(env_path, "w") as f:
-            f.writelines(new_lines)
+        with open(env_path, "rb") as f:
+            data = f.read()
+        data = ENV_TOKEN_PATTERN.sub(substitute, data)
+        missing = [key + b"=" + value + b"\n" for key, value in updates.items() if key not in replaced]
+        if missing:
+            if data and not data.endswith(b"\n"):
+                data += b"\n"
+            data += b"".join(missing)
+        # Write to a temp file in the same directory, then swap it in so a crash never leaves a truncated .env
+        with tempfile.NamedTemporaryFile(dir=env_path.parent, delete=False) as f:
+            tmp_path = f.name
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # NamedTemporaryFile is created 0600; keep the original .env permissions
+        os.chmod(tmp_path, stat.S_IMODE(env_path.stat().st_mode))
+        os.replace(tmp_path, env_path)
         logging.info(".env updated successfully")
     except IOError as e:
         logging.error(f"Failed to update .env: {e}")
+        if tmp_path:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
 
 
 class Bot(commands.Bot):
@@ -124,25 +154,60 @@ class Bot(commands.Bot):
         )
         self.access_token = access_token
         self.refresh_token_value = TWITCH_REFRESH_TOKEN
+        self._token_expiry_ts: float = 0.0  # time.monotonic() at which the access token expires
+        self._refresh_lock = asyncio.Lock()
+        self.sheet = None  # set by startup() once init_sheet completes
+        self._sheet_lock = asyncio.Lock()
+        self._token_task = None
+        self._creds_task = None
+        self._points_cache: dict[str, int] = {}  # casefolded username -> tokens
+        self._points_cache_ts: float = 0.0
+        # Shared client so OAuth calls reuse one keep-alive TLS connection to id.twitch.tv
+        self.http = httpx.AsyncClient(
+            base_url="https://id.twitch.tv",
+            # Keep idle connections long enough for the validate that follows a refresh (60s +/- 30s jitter)
+            limits=httpx.Limits(max_keepalive_connections=5, max_connections=10, keepalive_expiry=120.0),
+            timeout=10.0
+        )
 
-    async def ensure_valid_token(self):
-        """Ensure the token is valid, refreshing if needed. Return True if valid."""
-        expires_in, scopes = validate_token(self.access_token)
-        if expires_in < 300 and all(s in scopes for s in ["chat:read", "chat:edit"]):
-            return True
-        logging.info("Refreshing token...")
-        new_access_token, new_refresh_token = refresh_access_token(self.refresh_token_value)
-        if new_access_token and new_refresh_token:
-            self.access_token = new_access_token
-            self.refresh_token_value = new_refresh_token
-            self._connection._token = new_access_token
-            update_env_file(new_access_token, new_refresh_token)
+    async def ensure_valid_token(self, force=False):
+        """Ensure the token is valid, refreshing if needed. Return True if valid.
+
+        With force=True, always call /oauth2/validate instead of trusting the cached expiry.
+        """
+        # Skip the HTTPS round-trip while the last validated expiry is still far enough away
+        if not force and self._token_expiry_ts - time.monotonic() > 300:
             return True
-        logging.error("Failed to refresh token.")
-        return False
+        async with self._refresh_lock:
+            # Another coroutine may have validated or refreshed while we waited for the lock
+            if not force and self._token_expiry_ts - time.monotonic() > 300:
+                return True
+            expires_in, scopes = await validate_token(self.http, self.access_token)
+            if expires_in > 300 and all(s in scopes for s in ["chat:read", "chat:edit"]):
+                self._token_expiry_ts = time.monotonic() + expires_in
+                return True
+            logging.info("Refreshing token...")
+            new_access_token, new_refresh_token = await refresh_access_token(self.http, self.refresh_token_value)
+            if new_access_token and new_refresh_token:
+                self.access_token = new_access_token
+                self.refresh_token_value = new_refresh_token
+                self._connection._token = new_access_token
+                self._token_expiry_ts = 0.0  # validate the new token on the next check
+                update_env_file(new_access_token, new_refresh_token)
+                return True
+            logging.error("Failed to refresh token.")
+            return False
+
+    async def close(self):
+        """Close the OAuth HTTP client along with the IRC connection."""
+        await self.http.aclose()
+        await super().close()
 
     async def event_message(self, message):
-        if message.echo:
+        if message.echo or not message.content:
+            return
+        # Skip the command parser for plain chat; replies start with "@user " so let them through
+        if not message.content.startswith("!") and "reply-parent-msg-id" not in (message.tags or {}):
             return
         await self.handle_commands(message)
 
@@ -150,33 +215,86 @@ class Bot(commands.Bot):
         logging.info(f"Bot {self.nick} is online.")
         channel = self.connected_channels[0]
         await channel.send("Bot is online!")
-        # noinspection PyAsyncCall
-        self.loop.create_task(self.token_refresh_loop())
+        # event_ready fires again on every reconnect; keep one instance of each background loop
+        if self._token_task is None or self._token_task.done():
+            self._token_task = self.loop.create_task(self.token_refresh_loop())
+        if self.sheet and (self._creds_task is None or self._creds_task.done()):
+            self._creds_task = self.loop.create_task(self.sheet_credentials_refresh_loop())
 
     async def token_refresh_loop(self):
-        """Periodically check and refresh token."""
+        """Validate the token hourly and refresh it shortly before it expires."""
         while True:
-            if not await self.ensure_valid_token():
+            # Always hit /oauth2/validate here: Twitch requires an hourly validate, and it catches revoked tokens
+            if not await self.ensure_valid_token(force=True):
                 logging.error("Token refresh failed in loop.")
-            await asyncio.sleep(300)  # Check every 5 minutes (change to 3600)
+            # Wake up 5 minutes before expiry but at least hourly (less the jitter below);
+            # retry in a minute after a refresh or failure
+            sleep_s = min(3600 - 30, max(60, self._token_expiry_ts - time.monotonic() - 300))
+            # Jitter so several bot instances don't hit id.twitch.tv at the same moment
+            await asyncio.sleep(sleep_s + random.uniform(-30, 30))
+
+    async def sheet_credentials_refresh_loop(self):
+        """Refresh Google credentials ahead of expiry so lookups never wait on JWT signing."""
+        # The credentials object gspread's authorized session signs requests with
+        credentials = self.sheet.client.auth
+        while True:
+            try:
+                delay = 0
+                if credentials.expiry:
+                    # google-auth refreshes inline within ~4 minutes of expiry, so stay ahead of that
+                    now = datetime.now(timezone.utc).replace(tzinfo=None)
+                    delay = max(0, (credentials.expiry - now).total_seconds() - 300)
+                await asyncio.sleep(delay)
+                async with self._sheet_lock:
+                    await asyncio.to_thread(credentials.refresh, Request())
+                logging.info("Google credentials refreshed")
+            except GoogleAuthError as e:
+                logging.error(f"Google credentials refresh failed: {e}")
+                await asyncio.sleep(60)
+            except Exception as e:  # keep the loop alive on anything unexpected
+                logging.error(f"Unexpected error refreshing Google credentials: {e}")
+                await asyncio.sleep(60)
 
     def get_user_points(self, username):
         """Retrieve custom tokens for a given user from Google Sheet."""
         if not self.sheet:
             logging.error("Google Sheets not initialized")
             return None
+        # Serve from the cached sheet snapshot for up to a minute
+        if time.monotonic() - self._points_cache_ts < 60:
+            return self._points_cache.get(username.casefold(), 0)
         try:
-            records = self.sheet.get_all_records()
-            for record in records:
-                if record.get("Username", "").lower() == username.lower():
-                    return record.get("Tokens", 0)
-            return 0
+            # Fetch only the Username (A) and Tokens (B) columns, below the header, in one request
+            ranges = [
+                gspread.utils.absolute_range_name(self.sheet.title, "A2:A"),
+                gspread.utils.absolute_range_name(self.sheet.title, "B2:B")
+            ]
+            response = self.sheet.spreadsheet.values_batch_get(
+                ranges, params={"valueRenderOption": "UNFORMATTED_VALUE"}
+            )
+            usernames, tokens = (value_range.get("values", []) for value_range in response["valueRanges"])
+            points_cache = {}
+            for name, count in zip_longest(usernames, tokens, fillvalue=[]):
+                if not name:
+                    continue
+                value = count[0] if count else 0
+                try:
+                    value = int(value or 0)
+                except (TypeError, ValueError):
+                    logging.warning(f"Skipping non-numeric Tokens value {value!r} for {name[0]}")
+                    continue
+                points_cache[str(name[0]).casefold()] = value
+            self._points_cache = points_cache
+            return self._points_cache.get(username.casefold(), 0)
         except gspread.exceptions.APIError as e:
             logging.error(f"Google Sheets API error: {e}")
             return None
         except Exception as e:  # which exception
             logging.error(f"Error getting tokens: {e}")
             return None
+        finally:
+            # Stamp even on failure so a broken sheet costs one request per minute, not one per command
+            self._points_cache_ts = time.monotonic()
 
     def update_user_points(self, username, points):
         """Update custom tokens for a given user."""
@@ -187,18 +305,31 @@ class Bot(commands.Bot):
         if not await self.ensure_valid_token():
             await ctx.send("Access token expired. Please contact the bot owner.")
             return
-        points = self.get_user_points(ctx.author.name)
+        # gspread is blocking; keep the Sheets request off the event loop
+        async with self._sheet_lock:
+            points = await asyncio.to_thread(self.get_user_points, ctx.author.name)
         if points:
             await ctx.send(f"@{ctx.author.name}, you have {points} tokens.")
         else:
             await ctx.send(f"Error retrieving tokens for @{ctx.author.name}.")
 
 
+async def startup(bot):
+    """Validate the Twitch token and open the sheet concurrently. Return True if the token is valid."""
+    token_valid, bot.sheet = await asyncio.gather(
+        bot.ensure_valid_token(),
+        asyncio.to_thread(init_sheet)
+    )
+    return token_valid
+
+
 if __name__ == "__main__":
     # Validate and refresh token before starting bot
     access_token = TWITCH_ACCESS_TOKEN
     bot = Bot(access_token)
-    if not asyncio.run(bot.ensure_valid_token()):
+    # Run on the bot's own loop so the HTTP client's pooled connections stay usable
+    if not bot.loop.run_until_complete(startup(bot)):
         logging.error("Failed to ensure valid token at startup. Exiting.")
+        bot.loop.run_until_complete(bot.http.aclose())
         exit(1)
     bot.run()